@@ -1,17 +1,23 @@
 import os
+import re
 import base64
+import hashlib
+import random
+import itertools
 import time
-import json
 import logging
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Semaphore
+from threading import Lock, Semaphore
 
 # --- Library to load .env file for local development ---
 from dotenv import load_dotenv
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, jsonify
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage
 
 # --- Load environment variables from .env file for local development ---
@@ -30,22 +36,48 @@ GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
 
 SPOTIFY_AUTH_URL = "https://accounts.spotify.com/api/token"
 SPOTIFY_API_BASE_URL = "https://api.spotify.com/v1"
+# Spotify artist IDs are 22-character base62 strings
+_ARTIST_ID_RE = re.compile(r"^[0-9A-Za-z]{22}$")
+# Token shared by all workers/containers so a cold start can skip the auth round-trip
+TOKEN_CACHE_BLOB_NAME = f"_cache/spotify_token_{CLIENT_ID}.json"
 
 # --- Performance and Stability Tuning ---
-MAX_WORKERS = 30
+# Also sizes Gunicorn's threads per worker (see gunicorn.conf.py)
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "30"))
 # *** FIX: Lowered the concurrency limit to a safer value to avoid 429 errors. ***
 API_CONCURRENCY_LIMIT = 10
 MAX_RETRIES = 3 # Number of times to retry a failed API request
+MAX_RETRY_SECONDS = 60 # Overall time budget for retrying a single API request
+HTTP_TIMEOUT = (5, 30) # (connect, read) seconds, so a hung Spotify socket can't wedge a worker
+# One connection pool per Spotify host (accounts.spotify.com, api.spotify.com)
+SPOTIFY_HOST_COUNT = 2
 
 # Batches for enrichment endpoints
 ALBUM_BATCH_SIZE = 20
 TRACK_BATCH_SIZE = 50
+# Re-fetch full album/track objects (adds e.g. 'popularity'). Off by default to save API calls.
+ENRICH_ALBUMS = os.getenv("ENRICH_ALBUMS", "false").lower() == "true"
+ENRICH_TRACKS = os.getenv("ENRICH_TRACKS", "false").lower() == "true"
+# Rows per newline-delimited JSON object uploaded to GCS
+NDJSON_BATCH_SIZE = 1000
+# Chunk size for resumable uploads. upload_from_string sends payloads of up to 8 MiB as a single
+# multipart POST; only larger NDJSON batches fall back to a resumable upload in chunks of this size.
+GCS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# How long a stored ETL summary is served before the artist is processed again
+ARTIST_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Per-artist lock serializing upload + stale-blob cleanup across concurrent requests
+ARTIST_LOCK_WAIT_SECONDS = 60 # How long a run waits for another run on the same artist
+ARTIST_LOCK_TTL_SECONDS = 300 # Older locks are assumed to belong to a crashed worker
 
 # --- Rate Limiting Semaphore ---
 api_semaphore = Semaphore(API_CONCURRENCY_LIMIT)
 
 # --- Best Practice: Use a Session object for connection pooling ---
 http_session = requests.Session()
+# The default adapter keeps only 10 connections per host, fewer than MAX_WORKERS,
+# so extra threads would block or discard their sockets. Size the pool to match.
+# The GCS client manages its own transport and does not share this pool.
+http_session.mount("https://", HTTPAdapter(pool_connections=SPOTIFY_HOST_COUNT, pool_maxsize=MAX_WORKERS, max_retries=0))
 
 # Initialize GCS client
 try:
@@ -58,160 +90,364 @@ except Exception as e:
 # ==============================================================================
 # 2. Access Token Caching
 # ==============================================================================
-_token_cache: Dict[str, Any] = {"token": None, "expires_at": 0}
+# (token, expires_at) is swapped as one immutable tuple so readers never see half-updated state.
+_token_cache: Tuple[Optional[str], float] = (None, 0)
+# Serializes refreshes so concurrent workers don't all POST to the token endpoint at once.
+_token_lock = Lock()
+
+def _set_cached_token(token: str, expires_at: float):
+    """Caches the token and sets it as the default Authorization header on the shared session."""
+    global _token_cache
+    _token_cache = (token, expires_at)
+    http_session.headers["Authorization"] = f"Bearer {token}"
+
+def _get_cached_token() -> Optional[str]:
+    """Returns the in-memory token if it is still valid."""
+    token, expires_at = _token_cache
+    return token if token and time.time() < expires_at else None
+
+def _read_shared_token() -> Dict[str, Any]:
+    """
+    Reads the token cached in GCS by any worker.
+    Returns {"token", "expires_at", "generation"}; generation is 0 if no token is stored yet,
+    and the dict is empty if the cache could not be read (callers then rely on memory only).
+    """
+    if not gcs_bucket: return {}
+    try:
+        blob = gcs_bucket.get_blob(TOKEN_CACHE_BLOB_NAME)
+        if blob is None: return {"generation": 0}
+        cached = orjson.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+        return {**cached, "generation": blob.generation}
+    except Exception as e:
+        logging.warning(f"Could not read shared token cache: {e}")
+        return {}
+
+def _write_shared_token(token: str, expires_at: float, generation: Optional[int]):
+    """Stores the token in GCS, only if nobody else has replaced it since it was read."""
+    if not gcs_bucket or generation is None: return
+    try:
+        blob = gcs_bucket.blob(TOKEN_CACHE_BLOB_NAME)
+        blob.upload_from_string(
+            orjson.dumps({"token": token, "expires_at": expires_at}),
+            content_type="application/json",
+            if_generation_match=generation
+        )
+    except PreconditionFailed:
+        logging.info("Shared token cache was refreshed by another worker; keeping ours in memory.")
+    except Exception as e:
+        logging.warning(f"Could not write shared token cache: {e}")
 
 def get_access_token() -> str:
-    """Retrieves a Spotify API access token, caching it."""
-    if _token_cache["token"] and time.time() < _token_cache["expires_at"]:
-        return _token_cache["token"]
-    
-    auth_header = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode("utf-8")).decode("utf-8")
-    response = requests.post(
-        SPOTIFY_AUTH_URL,
-        headers={"Authorization": f"Basic {auth_header}"},
-        data={"grant_type": "client_credentials"}
-    )
-    response.raise_for_status()
-    token_info = response.json()
-    _token_cache["token"] = token_info["access_token"]
-    _token_cache["expires_at"] = time.time() + token_info["expires_in"] - 60
-    return _token_cache["token"]
+    """
+    Retrieves a Spotify API access token, caching it in memory and in GCS.
+    The token is also set on http_session, so Spotify calls need no explicit headers.
+    """
+    token = _get_cached_token()
+    if token: return token
+
+    with _token_lock:
+        # Another thread may have refreshed the token while we waited for the lock.
+        token = _get_cached_token()
+        if token: return token
+
+        shared = _read_shared_token()
+        if shared.get("token") and time.time() < shared.get("expires_at", 0):
+            _set_cached_token(shared["token"], shared["expires_at"])
+            return shared["token"]
+
+        auth_header = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode("utf-8")).decode("utf-8")
+        response = http_session.post(
+            SPOTIFY_AUTH_URL,
+            headers={"Authorization": f"Basic {auth_header}"},
+            data={"grant_type": "client_credentials"},
+            timeout=HTTP_TIMEOUT
+        )
+        response.raise_for_status()
+        token_info = orjson.loads(response.content)
+        token, expires_at = token_info["access_token"], time.time() + token_info["expires_in"] - 60
+        _set_cached_token(token, expires_at)
+        _write_shared_token(token, expires_at, shared.get("generation"))
+        return token
 
 # ==============================================================================
 # 3. Core Helper Functions
 # ==============================================================================
 
-def upload_to_gcs(bucket: storage.Bucket, destination_blob_name: str, data: Dict[str, Any]):
-    """Uploads a dictionary to a GCS bucket as a JSON file."""
-    if not bucket: raise ConnectionError("GCS bucket is not configured.")
+def to_ndjson(items: List[Dict[str, Any]]) -> bytes:
+    """Serializes a list of dictionaries as newline-delimited JSON."""
+    return b"\n".join(orjson.dumps(item) for item in items)
+
+def content_addressed_blob_name(prefix: str, payload: bytes) -> str:
+    """Names a blob after a hash of its payload, so identical content always maps to the same object."""
+    return f"{prefix}-{hashlib.sha256(payload).hexdigest()[:16]}.json"
+
+def upload_to_gcs(bucket: storage.Bucket, destination_blob_name: str, payload: bytes) -> bool:
+    """
+    Uploads an NDJSON payload to a GCS bucket unless the blob already exists (if_generation_match=0),
+    which makes re-uploading content-addressed blobs a no-op. Returns False if the upload was skipped.
+    """
     try:
-        blob = bucket.blob(destination_blob_name)
-        blob.upload_from_string(json.dumps(data).encode("utf-8"), content_type="application/json")
+        blob = bucket.blob(destination_blob_name, chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+        blob.upload_from_string(payload, content_type="application/x-ndjson", if_generation_match=0)
+        return True
+    except PreconditionFailed:
+        return False
     except Exception as e:
         logging.error(f"GCS upload failed for gs://{bucket.name}/{destination_blob_name}: {e}")
         raise
 
-def fetch_spotify_data_throttled(session: requests.Session, url: str, headers: Dict[str, str], params: Dict = None) -> Dict:
+def upload_many_to_gcs(bucket: storage.Bucket, uploads: List[Tuple[str, bytes]]):
+    """
+    Uploads (destination_blob_name, payload) pairs to a GCS bucket concurrently.
+    upload_from_string knows each payload's size, so payloads up to 8 MiB go in a single multipart POST.
+    """
+    if not bucket: raise ConnectionError("GCS bucket is not configured.")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(upload_to_gcs, bucket, name, payload) for name, payload in uploads]
+        skipped = sum(1 for future in as_completed(futures) if not future.result())
+    if skipped: logging.info(f"Skipped {skipped} unchanged blobs already in GCS.")
+
+def delete_stale_blobs(bucket: storage.Bucket, prefix: str, keep: set):
+    """Deletes blobs under a prefix that are not in 'keep'."""
+    stale = [blob for blob in bucket.list_blobs(prefix=prefix) if blob.name not in keep]
+    if stale:
+        logging.info(f"Deleting {len(stale)} stale blobs under gs://{bucket.name}/{prefix}")
+        bucket.delete_blobs(stale, on_error=lambda blob: logging.warning(f"Could not delete stale blob {blob.name}"))
+
+def acquire_artist_lock(bucket: storage.Bucket, artist_id: str) -> int:
+    """
+    Takes a per-artist lock by creating _locks/{artist_id}.lock with if_generation_match=0,
+    waiting up to ARTIST_LOCK_WAIT_SECONDS for another run to release it.
+    Returns the lock's generation, which is needed to release it.
+    """
+    blob = bucket.blob(f"_locks/{artist_id}.lock")
+    give_up_at = time.monotonic() + ARTIST_LOCK_WAIT_SECONDS
+    while True:
+        try:
+            blob.upload_from_string(b"", if_generation_match=0)
+            return blob.generation
+        except PreconditionFailed:
+            held = bucket.get_blob(blob.name)
+            if held is not None and time.time() - held.time_created.timestamp() > ARTIST_LOCK_TTL_SECONDS:
+                logging.warning(f"Breaking stale lock gs://{bucket.name}/{blob.name}")
+                try:
+                    held.delete(if_generation_match=held.generation)
+                except (NotFound, PreconditionFailed):
+                    pass
+                continue
+            if time.monotonic() > give_up_at:
+                raise TimeoutError(f"Timed out waiting for another run to finish storing artist {artist_id}.")
+            time.sleep(random.uniform(1, 2))
+
+def release_artist_lock(bucket: storage.Bucket, artist_id: str, generation: int):
+    """Releases a lock taken by acquire_artist_lock, unless it has since been broken and re-taken."""
+    try:
+        bucket.blob(f"_locks/{artist_id}.lock").delete(if_generation_match=generation)
+    except (NotFound, PreconditionFailed):
+        logging.warning(f"Lock for artist {artist_id} was broken by another run before release.")
+
+def read_artist_cache(bucket: storage.Bucket, artist_id: str) -> Optional[Dict[str, Any]]:
+    """Returns the cached ETL summary for an artist if it exists and has not expired."""
+    try:
+        blob = bucket.get_blob(f"artist_cache/{artist_id}.json")
+        if blob is None or float((blob.metadata or {}).get("expires_at", 0)) <= time.time():
+            return None
+        return orjson.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+    except Exception as e:
+        logging.warning(f"Could not read artist cache for {artist_id}: {e}")
+        return None
+
+def write_artist_cache(bucket: storage.Bucket, artist_id: str, summary: Dict[str, Any]):
+    """Stores an ETL summary for an artist, valid for ARTIST_CACHE_TTL_SECONDS."""
+    try:
+        blob = bucket.blob(f"artist_cache/{artist_id}.json")
+        blob.metadata = {"expires_at": str(time.time() + ARTIST_CACHE_TTL_SECONDS)}
+        blob.upload_from_string(orjson.dumps(summary), content_type="application/json")
+    except Exception as e:
+        logging.warning(f"Could not write artist cache for {artist_id}: {e}")
+
+def _backoff_seconds(attempt: int, retry_after: Optional[str] = None) -> float:
+    """
+    Returns how long to wait before the next attempt: Spotify's 'Retry-After' if given
+    (it may be fractional), otherwise exponential backoff. Up to 25% random jitter is added
+    so threads that were throttled together don't all retry at the same instant.
+    """
+    try:
+        wait = float(retry_after or 0) or float(2 ** attempt)
+    except ValueError:
+        wait = float(2 ** attempt)
+    return wait + random.uniform(0, wait * 0.25)
+
+def fetch_spotify_data_throttled(session: requests.Session, url: str, params: Dict = None) -> Dict:
     """
     A thread-safe, rate-limit-aware, and resilient function to fetch data from Spotify.
-    - Uses a semaphore to limit active concurrent requests.
+    - Uses a semaphore to limit active concurrent requests (released while backing off).
     - Uses a session object for efficient connection pooling.
-    - Automatically retries on 429 (Too Many Requests) errors with exponential backoff.
+    - Automatically retries on 429 (Too Many Requests) errors with jittered exponential backoff,
+      giving up after MAX_RETRIES attempts or MAX_RETRY_SECONDS, whichever comes first.
     """
-    with api_semaphore:
-        for attempt in range(MAX_RETRIES):
-            try:
-                response = session.get(url, headers=headers, params=params, timeout=10)
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.HTTPError as e:
-                # *** FIX: Robust retry logic for 429 errors. ***
-                if e.response.status_code == 429:
-                    # Use the 'Retry-After' header from Spotify, or default to exponential backoff
-                    retry_after = int(e.response.headers.get("Retry-After", (2 ** attempt)))
-                    logging.warning(
-                        f"Rate limited on attempt {attempt + 1}/{MAX_RETRIES}. "
-                        f"Waiting {retry_after} seconds before retrying {url}."
-                    )
-                    time.sleep(retry_after)
-                else:
-                    # For other HTTP errors (404, 500, etc.), fail immediately.
-                    logging.error(f"Non-retriable HTTP Error fetching {url}: {e}")
-                    raise
-            except (requests.exceptions.RequestException) as e:
-                logging.error(f"A network error occurred: {e}")
-                # For network errors, a simple backoff is often sufficient.
-                time.sleep(2 ** attempt)
-        
-        # If all retries fail, raise the last error.
-        raise Exception(f"Failed to fetch {url} after {MAX_RETRIES} attempts.")
+    deadline = time.monotonic() + MAX_RETRY_SECONDS
+    for attempt in range(MAX_RETRIES):
+        try:
+            # The semaphore gates only the request itself, so backoff sleeps don't hold a permit.
+            with api_semaphore:
+                response = session.get(url, params=params, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            return orjson.loads(response.content)
+        except requests.exceptions.HTTPError as e:
+            # *** FIX: Robust retry logic for 429 errors. ***
+            if e.response.status_code == 429:
+                # Use the 'Retry-After' header from Spotify, or default to exponential backoff
+                wait = _backoff_seconds(attempt, e.response.headers.get("Retry-After"))
+                logging.warning(
+                    f"Rate limited on attempt {attempt + 1}/{MAX_RETRIES}. "
+                    f"Waiting {wait:.2f} seconds before retrying {url}."
+                )
+            else:
+                # For other HTTP errors (404, 500, etc.), fail immediately.
+                logging.error(f"Non-retriable HTTP Error fetching {url}: {e}")
+                raise
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            # A truncated or non-JSON body is treated like a network error and retried.
+            logging.error(f"A network error occurred: {e}")
+            # For network errors, a simple backoff is often sufficient.
+            wait = _backoff_seconds(attempt)
+        # Don't sleep when no retry will follow.
+        if attempt == MAX_RETRIES - 1 or time.monotonic() + wait > deadline:
+            break
+        time.sleep(wait)
+    
+    # If all retries fail, raise the last error.
+    raise Exception(f"Failed to fetch {url} after {attempt + 1} attempts.")
 
 # ==============================================================================
 # 4. Main ETL Orchestration
 # ==============================================================================
 
-def run_full_etl_process(artist_name: str) -> Dict[str, Any]:
-    """Orchestrates the entire ETL pipeline from artist name to GCS upload."""
-    start_time = time.time()
-    access_token = get_access_token()
-    headers = {"Authorization": f"Bearer {access_token}"}
-    
-    # STEP 1 & 2: Get Artist ID and Details
+def find_artist(artist_name: str) -> Dict[str, Any]:
+    """Returns the full artist object for a Spotify artist ID, or searches for it by name."""
+    get_access_token()
+    if _ARTIST_ID_RE.fullmatch(artist_name):
+        try:
+            artist_details = fetch_spotify_data_throttled(http_session, f"{SPOTIFY_API_BASE_URL}/artists/{artist_name}")
+            logging.info(f"Found Artist: {artist_details['name']} ({artist_details['id']})")
+            return artist_details
+        except requests.exceptions.HTTPError as e:
+            # A 22-character name that isn't a valid ID falls back to a regular search.
+            if e.response.status_code not in (400, 404): raise
+
     search_url = f"{SPOTIFY_API_BASE_URL}/search"
     search_params = {"q": artist_name, "type": "artist", "limit": 1}
-    search_results = fetch_spotify_data_throttled(http_session, search_url, headers, search_params)
+    search_results = fetch_spotify_data_throttled(http_session, search_url, search_params)
     artist_items = search_results.get("artists", {}).get("items", [])
     if not artist_items: raise ValueError(f"Artist '{artist_name}' not found.")
     artist_id = artist_items[0]['id']
 
     artist_url = f"{SPOTIFY_API_BASE_URL}/artists/{artist_id}"
-    artist_details = fetch_spotify_data_throttled(http_session, artist_url, headers)
+    artist_details = fetch_spotify_data_throttled(http_session, artist_url)
     logging.info(f"Found Artist: {artist_details['name']} ({artist_id})")
+    return artist_details
 
-    # STEP 3: Gather Simplified Albums
-    logging.info("Gathering all album IDs...")
-    simplified_albums = []
-    album_url = f"{SPOTIFY_API_BASE_URL}/artists/{artist_id}/albums?limit=50"
-    first_album_page = fetch_spotify_data_throttled(http_session, album_url, headers)
-    simplified_albums.extend(first_album_page.get("items", []))
-    total_albums = first_album_page.get("total", 0)
-    album_page_urls = [f"{album_url}&offset={offset}" for offset in range(50, total_albums, 50)]
+def run_full_etl_process(artist_details: Dict[str, Any]) -> Dict[str, Any]:
+    """Orchestrates the ETL pipeline from the artist's discography to GCS upload."""
+    start_time = time.time()
+    get_access_token()
+    artist_id = artist_details['id']
 
+    # A single pool serves every Spotify fan-out stage below, rather than one pool per step.
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(fetch_spotify_data_throttled, http_session, url, headers) for url in album_page_urls]
-        for future in as_completed(futures):
-            simplified_albums.extend(future.result().get("items", []))
-    album_ids = list(set([album['id'] for album in simplified_albums])) # Use set to ensure uniqueness
-    logging.info(f"Gathered {len(album_ids)} unique album IDs.")
-
-    # STEP 4: Enrich Albums
-    logging.info("Enriching albums with popularity data...")
-    enriched_albums = []
-    album_id_chunks = [album_ids[i:i + ALBUM_BATCH_SIZE] for i in range(0, len(album_ids), ALBUM_BATCH_SIZE)]
-    
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        enrich_url = f"{SPOTIFY_API_BASE_URL}/albums"
-        futures = [executor.submit(fetch_spotify_data_throttled, http_session, enrich_url, headers, {"ids": ",".join(chunk)}) for chunk in album_id_chunks]
-        for future in as_completed(futures):
-            enriched_albums.extend(future.result().get('albums', []))
-    logging.info(f"Enriched {len(enriched_albums)} albums.")
-
-    # STEP 5 & 6: Gather and Enrich Tracks
-    logging.info("Gathering and enriching all tracks...")
-    all_track_ids = []
-    enriched_tracks = []
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit tasks to get simplified tracks from each album
-        track_page_futures = {executor.submit(fetch_spotify_data_throttled, http_session, f"{SPOTIFY_API_BASE_URL}/albums/{album_id}/tracks?limit=50", headers) for album_id in album_ids}
-        for future in as_completed(track_page_futures):
-            track_page = future.result()
-            all_track_ids.extend([track['id'] for track in track_page.get("items", []) if track])
-    
-    logging.info(f"Gathered {len(all_track_ids)} total track IDs.")
-    
-    # Enrich the gathered track IDs in batches
-    track_id_chunks = [all_track_ids[i:i + TRACK_BATCH_SIZE] for i in range(0, len(all_track_ids), TRACK_BATCH_SIZE)]
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        enrich_url = f"{SPOTIFY_API_BASE_URL}/tracks"
-        track_enrich_futures = [executor.submit(fetch_spotify_data_throttled, http_session, enrich_url, headers, {"ids": ",".join(chunk)}) for chunk in track_id_chunks]
-        for future in as_completed(track_enrich_futures):
-            enriched_tracks.extend(future.result().get('tracks', []))
-    logging.info(f"Enriched {len(enriched_tracks)} tracks.")
-    
+        # STEP 3: Gather Simplified Albums
+        logging.info("Gathering all album IDs...")
+        simplified_albums = []
+        album_url = f"{SPOTIFY_API_BASE_URL}/artists/{artist_id}/albums?limit=50"
+        first_album_page = fetch_spotify_data_throttled(http_session, album_url)
+        simplified_albums.extend(first_album_page.get("items", []))
+        total_albums = first_album_page.get("total", 0)
+        album_page_urls = [f"{album_url}&offset={offset}" for offset in range(50, total_albums, 50)]
+
+        album_pages = executor.map(lambda url: fetch_spotify_data_throttled(http_session, url), album_page_urls)
+        simplified_albums.extend(itertools.chain.from_iterable(page.get("items", []) for page in album_pages))
+        album_ids = list(dict.fromkeys(album['id'] for album in simplified_albums)) # Deduplicate, preserving order
+        albums_by_id = {album['id']: album for album in simplified_albums}
+
+        def album_row(album: Dict[str, Any]) -> Dict[str, Any]:
+            # 'album_group' only exists on /artists/{id}/albums items and isn't part of albums_schema.json.
+            return {key: value for key, value in album.items() if key != "album_group"}
+        logging.info(f"Gathered {len(album_ids)} unique album IDs.")
+
+        # STEP 4: Enrich Albums (optional)
+        if ENRICH_ALBUMS:
+            logging.info("Enriching albums with popularity data...")
+            # Spotify sometimes returns full album objects already; only re-fetch the rest.
+            enriched_albums = [album_row(albums_by_id[album_id]) for album_id in album_ids if "popularity" in albums_by_id[album_id]]
+            ids_to_enrich = [album_id for album_id in album_ids if "popularity" not in albums_by_id[album_id]]
+            album_id_chunks = [ids_to_enrich[i:i + ALBUM_BATCH_SIZE] for i in range(0, len(ids_to_enrich), ALBUM_BATCH_SIZE)]
+
+            enrich_url = f"{SPOTIFY_API_BASE_URL}/albums"
+            album_batches = executor.map(lambda chunk: fetch_spotify_data_throttled(http_session, enrich_url, {"ids": ",".join(chunk)}), album_id_chunks)
+            enriched_albums.extend(itertools.chain.from_iterable(batch.get('albums', []) for batch in album_batches))
+            logging.info(f"Enriched {len(enriched_albums)} albums.")
+        else:
+            enriched_albums = [album_row(albums_by_id[album_id]) for album_id in album_ids]
+
+        # STEP 5: Gather Simplified Tracks
+        logging.info("Gathering all tracks...")
+        simplified_tracks = []
+
+        # Every simplified album reports 'total_tracks', so all page offsets are known up-front
+        # and can be dispatched as one flat batch instead of being discovered page by page.
+        track_pages = [(album_id, offset) for album_id in album_ids for offset in range(0, albums_by_id[album_id].get("total_tracks", 0), 50)]
+
+        def fetch_track_page(track_page_key: tuple) -> Dict:
+            album_id, offset = track_page_key
+            tracks_url = f"{SPOTIFY_API_BASE_URL}/albums/{album_id}/tracks?limit=50&offset={offset}"
+            return fetch_spotify_data_throttled(http_session, tracks_url)
+
+        for (album_id, _), track_page in zip(track_pages, executor.map(fetch_track_page, track_pages)):
+            for track in track_page.get("items", []):
+                if track:
+                    # Simplified tracks carry no album, so attach the simplified album we already have.
+                    track.setdefault("album", albums_by_id[album_id])
+                    simplified_tracks.append(track)
+
+        logging.info(f"Gathered {len(simplified_tracks)} total tracks.")
+
+        # STEP 6: Enrich Tracks (optional)
+        if ENRICH_TRACKS:
+            logging.info("Enriching tracks with popularity data...")
+            enriched_tracks = [track for track in simplified_tracks if "popularity" in track]
+            ids_to_enrich = [track['id'] for track in simplified_tracks if "popularity" not in track]
+            track_id_chunks = [ids_to_enrich[i:i + TRACK_BATCH_SIZE] for i in range(0, len(ids_to_enrich), TRACK_BATCH_SIZE)]
+            enrich_url = f"{SPOTIFY_API_BASE_URL}/tracks"
+            track_batches = executor.map(lambda chunk: fetch_spotify_data_throttled(http_session, enrich_url, {"ids": ",".join(chunk)}), track_id_chunks)
+            enriched_tracks.extend(itertools.chain.from_iterable(batch.get('tracks', []) for batch in track_batches))
+            logging.info(f"Enriched {len(enriched_tracks)} tracks.")
+        else:
+            enriched_tracks = simplified_tracks
+
     # STEP 7: Upload All Data
+    # Each folder is written as NDJSON batches of NDJSON_BATCH_SIZE rows, named after their content.
     logging.info("Uploading all data to Google Cloud Storage...")
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        upload_futures = [executor.submit(upload_to_gcs, gcs_bucket, f"artists/{artist_id}.json", artist_details)]
-        for item in enriched_albums + enriched_tracks:
-            if item:
-                folder = "albums" if item['type'] == 'album' else "tracks"
-                upload_futures.append(executor.submit(upload_to_gcs, gcs_bucket, f"{folder}/{item['id']}.json", item))
-        
-        for future in as_completed(upload_futures):
-            future.result()
+    uploads = []
+    folders = (("artists", [artist_details]), ("albums", enriched_albums), ("tracks", enriched_tracks))
+    for folder, items in folders:
+        items = [item for item in items if item]
+        for i in range(0, len(items), NDJSON_BATCH_SIZE):
+            payload = to_ndjson(items[i:i + NDJSON_BATCH_SIZE])
+            uploads.append((content_addressed_blob_name(f"{folder}/{artist_id}", payload), payload))
+    # Changed batches get new names, so drop the previous ones to keep bq load free of duplicate rows.
+    # The lock keeps a concurrent run for the same artist from deleting the blobs this run just wrote.
+    lock_generation = acquire_artist_lock(gcs_bucket, artist_id)
+    try:
+        upload_many_to_gcs(gcs_bucket, uploads)
+        uploaded_names = {name for name, _ in uploads}
+        for folder, _ in folders:
+            delete_stale_blobs(gcs_bucket, f"{folder}/{artist_id}-", uploaded_names)
+    finally:
+        release_artist_lock(gcs_bucket, artist_id, lock_generation)
 
     total_time = time.time() - start_time
-    logging.info(f"SUCCESS: Full process for '{artist_name}' completed in {total_time:.2f} seconds.")
+    logging.info(f"SUCCESS: Full process for '{artist_details['name']}' completed in {total_time:.2f} seconds.")
 
     return {
         "artist_name": artist_details["name"], "artist_id": artist_id,
@@ -224,16 +460,24 @@ def run_full_etl_process(artist_name: str) -> Dict[str, Any]:
 # ==============================================================================
 @app.route("/")
 def index():
-    return "Spotify Full ETL (Enrichment Version). Usage: /artist/&lt;artist_name&gt;/store", 200
+    return "Spotify Full ETL (Enrichment Version). Usage: /artist/&lt;artist_name_or_id&gt;/store", 200
 
 @app.route("/artist/<string:artist_name>/store", methods=['GET'])
 def store_artist_data_endpoint(artist_name: str):
-    """API endpoint to trigger the full, multi-stage ETL process."""
+    """API endpoint to trigger the full, multi-stage ETL process, or serve its recent result."""
     if not gcs_bucket:
         return jsonify({"error": "GCS bucket is not configured correctly."}), 500
     try:
-        summary = run_full_etl_process(artist_name)
-        return jsonify({"message": "Successfully stored artist, albums, and tracks in GCS.", **summary})
+        # STEP 1 & 2: Get Artist ID and Details
+        artist_details = find_artist(artist_name)
+        summary = read_artist_cache(gcs_bucket, artist_details['id'])
+        if summary:
+            logging.info(f"Serving cached result for '{artist_details['name']}'.")
+            return jsonify({"message": "Artist, albums, and tracks were recently stored in GCS.", **summary, "cached": True})
+
+        summary = run_full_etl_process(artist_details)
+        write_artist_cache(gcs_bucket, artist_details['id'], summary)
+        return jsonify({"message": "Successfully stored artist, albums, and tracks in GCS.", **summary, "cached": False})
     except Exception as e:
         logging.error(f"A critical error occurred in the main endpoint: {e}", exc_info=True)
         return jsonify({"error": "An unexpected server error occurred", "details": str(e)}), 500
@@ -246,4 +490,4 @@ if __name__ == "__main__":
         raise SystemExit("ERROR: Ensure SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, and GCS_BUCKET_NAME are set.")
     if not gcs_bucket:
          raise SystemExit(f"ERROR: Could not connect to GCS bucket '{GCS_BUCKET_NAME}'.")
-    app.run(debug=True, host="0.0.0.0", port=8080)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=8080)
\ No newline at end of file
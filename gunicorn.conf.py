@@ -0,0 +1,18 @@
+# gunicorn.conf.py
+# Gunicorn loads this file automatically from the working directory.
+
+import os
+
+# Cloud Run sets the PORT environment variable.
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# Each ETL request spends most of its time waiting on Spotify and GCS, so threaded
+# workers let concurrent requests overlap instead of queueing behind one another.
+worker_class = "gthread"
+workers = 2
+# Threads per worker follow MAX_WORKERS. Writing the value back to the environment means
+# app.py, which workers import after this file is loaded, reads the same number.
+threads = int(os.environ.setdefault("MAX_WORKERS", "30"))
+
+# A full discography run can take well over Gunicorn's 30-second default.
+timeout = 120